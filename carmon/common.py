@@ -2,10 +2,23 @@
 Здесь предполагается размещение общих для всех компонентов констант
 """
 import os
+import gzip
+import json
+import time
+import base64
+import pickle
+import inspect
+import hashlib
+import functools
 import shutil
+import sqlite3
+import datetime
+import threading
+import email.utils
 
 import yaml
 import requests
+import urllib3
 import pandas as pd
 
 from os.path import split as split_it
@@ -28,16 +41,178 @@ default_settings = load_config(f"{WORKING_PATH}/common_settings.yaml")
 
 DEFAULT_RESPONSE = default_settings['default_response']
 BASE_URL = default_settings['paths']['base']
+# сигнатуры бинарных форматов, по которым `read_df` определяет способ чтения таблицы
+TABLE_MAGIC_BYTES = {"parquet": b"PAR1", "feather": b"ARROW1"}
 
 
-def read_df(table_path: str, separator="\t") -> dict:
+class PortalSession:
+    """
+    Сессия работы с порталом: токен, заголовки запросов и адрес портала. Все функции, обращающиеся к порталу,
+    принимают сессию аргументом `session`; если он не передан, используется общая `DEFAULT_SESSION`.
+    Отдельные сессии позволяют в одном процессе параллельно работать с разными токенами.
+    """
+
+    def __init__(self, token: str = None, base_url: str = BASE_URL, headers: dict = None):
+        self.base_url = base_url
+        if headers is None:
+            # общие заголовки уже содержат авторизацию токена `DEFAULT_SESSION`, ее новой сессии не передаем
+            headers = {name: value for name, value in default_settings['access']['headers'].items()
+                       if name.lower() != "authorization"}
+        self.headers = headers
+        self.token = None
+        if token is not None:
+            self.set_token(token)
+
+    def set_token(self, token: str):
+        self.token = token
+        self.headers["Authorization"] = f"Bearer {token}"
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+    @property
+    def cache_scope(self) -> str:
+        """
+        Идентификатор сессии для кэшей, зависящих от прав пользователя; сам токен в кэш не попадает.
+        """
+        return hashlib.sha256(f"{self.base_url}|{self.token}".encode()).hexdigest()[:16]
+
+
+# сессия по умолчанию разделяет заголовки с `default_settings`, чтобы прежний код продолжал работать
+DEFAULT_SESSION = PortalSession(headers=default_settings['access']['headers'])
+
+
+def table_dtypes() -> dict:
+    """
+    Словарь типов столбцов таблицы вида TABLE, собранный из `table_schema` настроек.
+    Столбцы с перечислимыми значениями получают категориальный тип с фиксированным набором категорий. \n \n
+    :return: словарь {столбец: dtype}, пригодный для `pd.read_csv` и `DataFrame.astype`.
+    """
+    dtypes = dict()
+    for column, dtype in default_settings['table_schema'].items():
+        if isinstance(dtype, dict):
+            dtypes[column] = pd.CategoricalDtype(dtype['categories'])
+        else:
+            dtypes[column] = dtype
+    return dtypes
+
+
+def apply_table_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Приведение столбцов таблицы вида TABLE к типам из `table_schema`. Пустые значения должны быть
+    представлены как <NA>, а не пустой строкой. Изменения производятся inplace. Значения, которых нет среди
+    категорий схемы, не превращаются молча в пропуски: в этом случае выбрасывается ValueError. \n \n
+    :param df: таблица вида TABLE (баркод в индексе);
+    :return: та же таблица с приведенными типами.
+    """
+    for column, dtype in table_dtypes().items():
+        if column in df.columns:
+            converted = df[column].astype(dtype)
+            lost = df[column].notna() & converted.isna()
+            if lost.any():
+                unknown = sorted(map(str, df.loc[lost, column].unique()))
+                raise ValueError(f"Column `{column}` has values outside of `table_schema` categories: {unknown}")
+            df[column] = converted
+    return df
+
+
+def make_barcodes(positions: pd.Series) -> pd.Series:
+    """
+    Построение баркодов образцов из номеров лунок плашки по настройкам `barcodes`,
+    например `5` -> `barcode05_MN908947.3`. \n \n
+    :param positions: номера лунок (строки);
+    :return: pd.Series баркодов с тем же индексом.
+    """
+    settings = default_settings['barcodes']
+    return settings['prefix'] + positions.astype(str).str.zfill(settings['width']) + settings['reference_suffix']
+
+
+def normalize_barcodes(names) -> pd.Index:
+    """
+    Приведение имен последовательностей из FASTA, Pangolin и NextClade к виду баркода TABLE: пробелы заменяются на
+    `_`, а недостающий `barcodes.reference_suffix` дописывается (`barcode05` и `barcode05 MN908947.3` дают
+    `barcode05_MN908947.3`). \n \n
+    :param names: имена последовательностей;
+    :return: pd.Index нормализованных баркодов в том же порядке.
+    """
+    suffix = default_settings['barcodes']['reference_suffix']
+    names = pd.Series(names, dtype="string").str.strip().str.replace(r"\s+", "_", regex=True)
+    return pd.Index(names.where(names.str.endswith(suffix), names + suffix))
+
+
+def barcode_join_report(index: pd.Index, keys: pd.Index) -> dict:
+    """
+    Отчет о сведении баркодов таблицы с баркодами внешнего источника. \n \n
+    :param index: баркоды таблицы вида TABLE;
+    :param keys: нормализованные баркоды источника;
+    :return: словарь со списками `matched` (есть в обоих), `missing` (нет в источнике)
+    и `unexpected` (нет в таблице).
+    """
+    return {
+        'matched': index.intersection(keys).tolist(),
+        'missing': index.difference(keys).tolist(),
+        'unexpected': keys.difference(index).tolist()
+    }
+
+
+def join_by_barcode(df: pd.DataFrame, values: pd.Series) -> tuple:
+    """
+    Сведение результатов внешнего источника с таблицей вида TABLE одним слиянием по хэшированному индексу.
+    Имена источника нормализуются `normalize_barcodes`, при повторах берется последнее значение. \n \n
+    :param df: таблица вида TABLE (баркод в индексе);
+    :param values: значения источника, индекс -- имена последовательностей в источнике;
+    :return: кортеж из значений, выровненных по индексу df (<NA> для отсутствующих в источнике),
+    и отчета о сведении `barcode_join_report`.
+    """
+    values = values.copy()
+    values.index = normalize_barcodes(values.index).astype(df.index.dtype)
+    values = values[~values.index.duplicated(keep='last')]
+    return values.reindex(df.index), barcode_join_report(df.index, values.index)
+
+
+def detect_table_format(table_path: str) -> str:
+    """
+    Определение формата файла таблицы по сигнатуре в начале файла. Бинарные форматы (Parquet, Feather)
+    определяются по magic bytes, все остальное считается текстовой таблицей. \n \n
+    :param table_path: путь к файлу таблицы;
+    :return: одно из `parquet`, `feather`, `text`.
+    """
+    with open(table_path, "rb") as fr:
+        head = fr.read(8)
+    for table_format, magic in TABLE_MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return table_format
+    return "text"
+
+
+def read_df(table_path: str, separator="\t", columns: list = None) -> dict:
+    """
+    Чтение таблицы вида TABLE с приведением столбцов к типам из `table_schema`. Формат файла (Parquet, Feather
+    или текстовая таблица) определяется автоматически. Пустые ячейки текстовой таблицы читаются как <NA>. \n \n
+    :param table_path: путь к файлу таблицы;
+    :param separator: разделитель в текстовом файле;
+    :param columns: список столбцов для чтения, `barcode` добавляется автоматически; по умолчанию -- все столбцы;
+    :return: словарь вида STATE, payload - DataFrame в случае успеха.
+    """
     response = DEFAULT_RESPONSE.copy()
     try:
-        df = pd.read_csv(table_path,
-                         sep=separator, dtype=str,
-                         keep_default_na=False, encoding="utf-8").set_index('barcode')
-        # увы, но один из элементов таблицы очень неудобно воспринимать как строку
-        df['valid_seq'] = df['valid_seq'].apply(lambda x: True if x == 'True' else False)
+        if columns is not None:
+            columns = ['barcode'] + [column for column in columns if column != 'barcode']
+        table_format = detect_table_format(table_path)
+        if table_format == "parquet":
+            df = pd.read_parquet(table_path, columns=columns)
+        elif table_format == "feather":
+            df = pd.read_feather(table_path, columns=columns)
+        else:
+            # пустыми считаем только пустые ячейки, иначе штрихкоды вроде `NA` превратятся в пропуски;
+            # категории читаем строками, чтобы неизвестные значения поймала проверка в apply_table_schema
+            dtypes = {column: "string[pyarrow]" if isinstance(dtype, pd.CategoricalDtype) else dtype
+                      for column, dtype in table_dtypes().items()}
+            df = pd.read_csv(table_path,
+                             sep=separator, dtype=dtypes, usecols=columns,
+                             keep_default_na=False, na_values=[""], encoding="utf-8")
+        # бинарные форматы хранят типы сами, но набор категорий приводим к схеме в любом случае
+        df = apply_table_schema(df).set_index('barcode')
     except Exception as e:
         response['payload'] = str(e)
     else:
@@ -47,19 +222,27 @@ def read_df(table_path: str, separator="\t") -> dict:
     return response
 
 
-# TODO: необходимо уточнить, что именно выступает в качестве payload в случае успеха этой функции
 def save_concatenated_table(pd_table, output_name, separator='\t'):
     """
-    Функция для сохранения сборной таблицы по указанному пути \n \n
+    Функция для сохранения сборной таблицы по указанному пути. Формат определяется расширением файла:
+    `.parquet` и `.feather` сохраняются в бинарном виде с сохранением типов, все остальное -- текстовой таблицей
+    с разделителем `separator`. \n \n
     :param pd_table: таблица для сохранения;
     :param output_name: путь и имя для итогового файла;
     :param separator: разделитель в текстовом файле;
-    :return: словарь вида STATE, payload - путь к сохраненному файлу в случае успеха.
+    :return: словарь вида STATE, payload - сообщение с путем к сохраненному файлу в случае успеха.
     """
     response = DEFAULT_RESPONSE.copy()
     try:
-        # обязательно пишем все в utf-8, чтобы не было в дальнейшем проблем
-        pd_table.to_csv(output_name, sep=separator, encoding="utf-8")
+        extension = os.path.splitext(output_name)[1].lower()
+        if extension == ".parquet":
+            pd_table.reset_index().to_parquet(output_name, index=False)
+        elif extension == ".feather":
+            # Feather не умеет хранить произвольный индекс, поэтому баркод пишем обычным столбцом
+            pd_table.reset_index().to_feather(output_name)
+        else:
+            # обязательно пишем все в utf-8, чтобы не было в дальнейшем проблем
+            pd_table.to_csv(output_name, sep=separator, encoding="utf-8")
     except Exception as e:
         response['payload'] = str(e)
     else:
@@ -69,19 +252,618 @@ def save_concatenated_table(pd_table, output_name, separator='\t'):
     return response
 
 
-def state_token(token) -> dict:
+def _connect_run_store(store_path: str) -> sqlite3.Connection:
+    """
+    Открытие хранилища прогонов с созданием таблиц и индексов при необходимости. \n \n
+    :param store_path: путь к файлу SQLite;
+    :return: соединение с базой.
+    """
+    columns = ", ".join(f'"{column}" TEXT' for column in default_settings['table_schema'])
+    connection = sqlite3.connect(store_path)
+    connection.execute("CREATE TABLE IF NOT EXISTS runs "
+                       "(run_id INTEGER PRIMARY KEY AUTOINCREMENT, run_name TEXT NOT NULL, ingested_at TEXT NOT NULL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS samples "
+                       f"(run_id INTEGER NOT NULL REFERENCES runs(run_id), {columns})")
+    # хранилище могло быть создано при прежнем составе столбцов TABLE, недостающие добавляем
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(samples)")}
+    for column in default_settings['table_schema']:
+        if column not in existing:
+            connection.execute(f'ALTER TABLE samples ADD COLUMN "{column}" TEXT')
+    for column in default_settings['run_store']['indexed']:
+        connection.execute(f'CREATE INDEX IF NOT EXISTS idx_samples_{column} ON samples ("{column}")')
+    return connection
+
+
+def ingest_run_table(df: pd.DataFrame, store_path: str, run_name: str) -> dict:
+    """
+    Добавление завершенной таблицы вида TABLE в локальное хранилище прогонов. Хранилище только пополняется:
+    повторная загрузка той же таблицы создает новый прогон, прежние записи не изменяются. \n \n
+    :param df: таблица вида TABLE (баркод в индексе);
+    :param store_path: путь к файлу SQLite хранилища;
+    :param run_name: имя прогона (например, имя плашки или итогового файла);
+    :return: словарь вида STATE, payload - run_id добавленного прогона в случае успеха.
+    """
+    response = DEFAULT_RESPONSE.copy()
+    connection = None
+    try:
+        columns = list(default_settings['table_schema'])
+        records = df.reset_index().reindex(columns=columns).astype(object)
+        records = records.where(records.notna(), None)
+        connection = _connect_run_store(store_path)
+        with connection:  # транзакция: прогон добавляется целиком или не добавляется вовсе
+            cursor = connection.execute("INSERT INTO runs (run_name, ingested_at) VALUES (?, ?)",
+                                        (run_name, datetime.datetime.now().isoformat(timespec='seconds')))
+            run_id = cursor.lastrowid
+            placeholders = ", ".join("?" for _ in range(len(columns) + 1))
+            quoted = ", ".join(f'"{column}"' for column in columns)
+            connection.executemany(f"INSERT INTO samples (run_id, {quoted}) VALUES ({placeholders})",
+                                   ([run_id] + list(row) for row in records.itertuples(index=False)))
+    except Exception as e:
+        response['payload'] = str(e)
+    else:
+        response['success'] = True
+        response['payload'] = run_id
+    finally:
+        if connection is not None:
+            connection.close()
+
+    return response
+
+
+def query_run_store(store_path: str, **filters) -> dict:
+    """
+    Поиск записей об образцах по всем прогонам хранилища. Фильтровать можно лишь по индексированным столбцам
+    (`run_store.indexed` в настройках), значение фильтра -- строка или список строк. Например,
+    `query_run_store(path, litech_barcode="123456")`. \n \n
+    :param store_path: путь к файлу SQLite хранилища;
+    :param filters: фильтры вида столбец=значение(я), объединяются через AND;
+    :return: словарь вида STATE, payload - DataFrame найденных записей с именем и временем прогона в случае успеха.
+    """
+    response = DEFAULT_RESPONSE.copy()
+    connection = None
+    try:
+        conditions, values = list(), list()
+        for column, value in filters.items():
+            if column not in default_settings['run_store']['indexed']:
+                raise AssertionError(f"Поиск по столбцу `{column}` не поддерживается")
+            value = [value] if isinstance(value, str) else list(value)
+            conditions.append(f'samples."{column}" IN ({", ".join("?" for _ in value)})')
+            values.extend(str(elem) for elem in value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        connection = _connect_run_store(store_path)
+        df = pd.read_sql_query("SELECT runs.run_name, runs.ingested_at, samples.* FROM samples "
+                               f"JOIN runs USING (run_id) {where} ORDER BY samples.run_id",
+                               connection, params=values)
+        # все столбцы хранилища текстовые, поэтому булевы `valid_seq` возвращаются строками '1'/'0'
+        df['valid_seq'] = df['valid_seq'].map({'1': True, '0': False, 1: True, 0: False})
+        df = apply_table_schema(df)
+    except Exception as e:
+        response['payload'] = str(e)
+    else:
+        response['success'] = True
+        response['payload'] = df
+    finally:
+        if connection is not None:
+            connection.close()
+
+    return response
+
+
+def _metadata_diff(old: dict, new: dict) -> dict:
+    """
+    Разница между двумя версиями справочника портала. \n \n
+    :param old: прежняя версия справочника;
+    :param new: свежая версия справочника;
+    :return: словарь с ключами `added`, `removed` и `changed` (для последнего -- пары [было, стало]).
+    """
+    return {
+        'added': {key: new[key] for key in new.keys() - old.keys()},
+        'removed': {key: old[key] for key in old.keys() - new.keys()},
+        'changed': {key: [old[key], new[key]] for key in old.keys() & new.keys() if old[key] != new[key]}
+    }
+
+
+_METADATA_CACHE_LOCK = threading.Lock()
+
+
+def cached_portal_metadata(name: str, fetch_func, force_refresh: bool = False,
+                           session: PortalSession = None) -> dict:
+    """
+    Получение справочника портала через дисковый кэш. Если сохраненная версия моложе `metadata_cache.ttl_hours`,
+    запрос на портал не производится. При обновлении справочника его версия увеличивается, а разница с прошлой
+    версией записывается в историю кэша и выводится пользователю. Пока включена кассета, кэш не используется. \n \n
+    :param name: имя справочника, должно быть объявлено в `metadata_cache.ttl_hours`;
+    :param fetch_func: функция без аргументов, запрашивающая справочник и возвращающая словарь вида STATE,
+    payload которого -- словарь со строковыми ключами;
+    :param force_refresh: запросить справочник с портала вне зависимости от срока жизни кэша;
+    :param session: сессия портала, справочники разных пользователей хранятся раздельно;
+    :return: словарь вида STATE, payload - справочник в случае успеха.
+    """
+    response = DEFAULT_RESPONSE.copy()
+    session = session or DEFAULT_SESSION
+    try:
+        # справочники зависят от прав пользователя, поэтому хранятся отдельно для каждой сессии
+        cache_key = f"{name}@{session.cache_scope}"
+        ttl = datetime.timedelta(hours=default_settings['metadata_cache']['ttl_hours'][name])
+        entry = None
+        # с кассетой кэш не читается и не пишется: справочник должен попасть в запись и не должен
+        # из воспроизведения попасть в настоящий кэш
+        if cassette_mode() is None and not force_refresh:
+            with _METADATA_CACHE_LOCK:
+                entry = _read_metadata_cache().get(cache_key)
+        if entry and datetime.datetime.now() - datetime.datetime.fromisoformat(entry['fetched_at']) < ttl:
+            metadata = entry['data']
+        else:
+            # запрос на портал идет без блокировки, чтобы медленный портал не задерживал другие сессии
+            fetched = fetch_func()
+            if not fetched['success']:
+                raise AssertionError(fetched['payload'])
+            metadata = fetched['payload']
+            if cassette_mode() is None:
+                with _METADATA_CACHE_LOCK:
+                    _store_metadata_cache(name, cache_key, metadata)
+    except Exception as e:
+        response['payload'] = str(e)
+    else:
+        response['success'] = True
+        response['payload'] = metadata
+
+    return response
+
+
+def _read_metadata_cache() -> dict:
+    """
+    Чтение дискового кэша справочников, вызывается под `_METADATA_CACHE_LOCK`. \n \n
+    :return: содержимое кэша или пустой словарь, если кэша еще нет.
+    """
+    cache_path = os.path.expanduser(default_settings['metadata_cache']['path'])
+    if not os.path.exists(cache_path):
+        return dict()
+    with open(cache_path, "r", encoding="utf-8") as fr:
+        return json.load(fr)
+
+
+def _store_metadata_cache(name: str, cache_key: str, metadata: dict):
+    """
+    Запись свежего справочника в дисковый кэш с увеличением версии и записью разницы при изменении,
+    вызывается под `_METADATA_CACHE_LOCK`. Кэш перечитывается, чтобы не затереть записи других сессий.
+    """
+    cache_path = os.path.expanduser(default_settings['metadata_cache']['path'])
+    cache = _read_metadata_cache()
+    entry = cache.get(cache_key)
+    now = datetime.datetime.now()
+    if entry is None:
+        entry = {'version': 1, 'data': metadata, 'history': list()}
+    elif entry['data'] != metadata:
+        diff = _metadata_diff(entry['data'], metadata)
+        entry['version'] += 1
+        entry['history'].append({'version': entry['version'], 'detected_at': now.isoformat(timespec='seconds'),
+                                 'diff': diff})
+        entry['data'] = metadata
+        print(f"Справочник `{name}` на портале изменился (версия {entry['version']}): "
+              f"добавлено {len(diff['added'])}, удалено {len(diff['removed'])}, "
+              f"изменено {len(diff['changed'])}")
+    entry['fetched_at'] = now.isoformat(timespec='seconds')
+    cache[cache_key] = entry
+    # пишем через временный файл, чтобы прерванная запись не испортила кэш
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(f"{cache_path}.tmp", "w", encoding="utf-8") as fw:
+        json.dump(cache, fw, ensure_ascii=False)
+    os.replace(f"{cache_path}.tmp", cache_path)
+
+
+class EndpointLimiter:
+    """
+    Ограничитель запросов к одному адресу портала. Число одновременных запросов и пауза между их началами
+    подстраиваются по принципу AIMD: каждый быстрый успешный ответ понемногу увеличивает число одновременных
+    запросов и сокращает паузу, а ошибка перегрузки (429/5xx, обрыв соединения) или слишком долгий ответ
+    уменьшают число запросов в `decrease_factor` раз и увеличивают паузу.
+    """
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.limit = float(settings['initial_concurrency'])
+        self.interval = 0.0
+        self.in_flight = 0
+        self.last_start = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                if self.in_flight < int(self.limit):
+                    wait = self.last_start + self.interval - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+            self.in_flight += 1
+            self.last_start = time.monotonic()
+
+    def release(self, latency: float, overloaded: bool):
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded or latency > self.settings['target_latency']:
+                self.limit = max(1.0, self.limit * self.settings['decrease_factor'])
+                increased = max(self.interval / self.settings['decrease_factor'], self.settings['interval_step'])
+                self.interval = min(self.settings['max_interval'], increased)
+            else:
+                self.limit = min(float(self.settings['max_concurrency']), self.limit + 1 / self.limit)
+                self.interval *= self.settings['decrease_factor']
+                if self.interval < self.settings['interval_step']:
+                    self.interval = 0.0
+            self.condition.notify_all()
+
+
+_ENDPOINT_LIMITERS = dict()
+_ENDPOINT_LIMITERS_LOCK = threading.Lock()
+
+
+def get_endpoint_limiter(endpoint: str) -> EndpointLimiter:
+    """
+    Ограничитель для адреса портала, общий для всех потоков процесса. \n \n
+    :param endpoint: адрес без query-параметров;
+    :return: EndpointLimiter для этого адреса.
+    """
+    with _ENDPOINT_LIMITERS_LOCK:
+        if endpoint not in _ENDPOINT_LIMITERS:
+            _ENDPOINT_LIMITERS[endpoint] = EndpointLimiter(default_settings['rate_limit'])
+        return _ENDPOINT_LIMITERS[endpoint]
+
+
+def _request_not_sent(error: Exception) -> bool:
+    """
+    Проверка, что запрос оборвался еще при установке соединения, то есть тело запроса до портала не дошло.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], "reason", None), urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def _retry_after_delay(value: str):
+    """
+    Пауза (сек), которую портал просит выдержать заголовком `Retry-After`: число секунд или HTTP-дата. \n \n
+    :return: неотрицательное число секунд или None, если заголовка нет или он не разобран.
+    """
+    value = (value or "").strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def _limited_request(method: str, url: str, idempotent: bool, **kwargs) -> requests.Response:
+    """
+    Запрос к порталу через адаптивный ограничитель адреса. Идемпотентные запросы повторяются до
+    `rate_limit.retries` раз при ответах из `rate_limit.retry_statuses` и обрывах соединения, неидемпотентные --
+    лишь при 429 и обрывах до отправки запроса, чтобы не загрузить и не выставить что-либо дважды.
+    Пауза из заголовка `Retry-After` (секунды или HTTP-дата) выдерживается полностью, но не дольше
+    `rate_limit.max_retry_after`. Без явного `timeout` запрос ограничивается `rate_limit.request_timeout`, чтобы
+    зависшее соединение не занимало место в ограничителе бесконечно. \n \n
+    :return: requests.Response последней попытки; исключение последней попытки поднимается, если ответа не было.
+    """
+    settings = default_settings['rate_limit']
+    kwargs.setdefault("timeout", tuple(settings['request_timeout']))
+    limiter = get_endpoint_limiter(url.split("?")[0])
+    for attempt in range(settings['retries'] + 1):
+        limiter.acquire()
+        started = time.monotonic()
+        portal_response, error, overloaded = None, None, True
+        try:
+            portal_response = requests.request(method, url, **kwargs)
+            overloaded = portal_response.status_code in settings['retry_statuses']
+        except Exception as e:
+            error = e
+        finally:
+            # место освобождается ровно один раз при любом исходе попытки, непредвиденные ошибки -- как перегрузка
+            limiter.release(time.monotonic() - started, overloaded)
+        last_attempt = attempt == settings['retries']
+        if error is not None:
+            if idempotent:
+                retriable = isinstance(error, (requests.ConnectionError, requests.Timeout))
+            else:
+                retriable = _request_not_sent(error)
+            if last_attempt or not retriable:
+                raise error
+            delay = limiter.interval
+        else:
+            retriable = idempotent or portal_response.status_code == 429
+            if not overloaded or not retriable or last_attempt:
+                return portal_response
+            retry_after = _retry_after_delay(portal_response.headers.get("Retry-After"))
+            if retry_after is not None:
+                # просьбу портала соблюдаем полностью, иначе повторы уйдут, пока он еще ограничивает запросы
+                time.sleep(min(retry_after, settings['max_retry_after']))
+                continue
+            delay = limiter.interval
+        time.sleep(min(delay, settings['max_interval']))
+
+
+# состояние кассеты записи/воспроизведения запросов к порталу, см. `start_cassette`
+_CASSETTE = {'mode': None, 'path': None, 'interactions': dict()}
+_CASSETTE_LOCK = threading.Lock()
+
+
+def _cassette_key(method: str, url: str, kwargs: dict) -> str:
+    """
+    Ключ запроса в кассете: хэш метода, адреса и тела запроса без заголовков и ключа авторизации,
+    поэтому кассета не содержит токенов и воспроизводится под любой учетной записью.
+    """
+    body = {field: kwargs.get(field) for field in ("params", "data", "json", "files")}
+    if isinstance(body['files'], dict):
+        body['files'] = {key: value for key, value in body['files'].items() if key != "auth_key"}
+    plain = json.dumps([method.upper(), url, body], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(plain.encode()).hexdigest()
+
+
+def start_cassette(cassette_path: str, mode: str = "record") -> dict:
+    """
+    Включение кассеты для всех запросов к порталу через `portal_request`.
+    В режиме `record` запросы уходят на портал, а ответы сохраняются; запись на диск -- при `stop_cassette`.
+    В режиме `replay` ответы выдаются из ранее записанной кассеты без обращения к сети, повторяющиеся запросы
+    получают ответы в порядке записи. \n \n
+    :param cassette_path: путь к файлу кассеты (json, сжатый gzip);
+    :param mode: `record` или `replay`;
+    :return: словарь вида STATE, payload - сообщение о включении кассеты в случае успеха.
+    """
+    response = DEFAULT_RESPONSE.copy()
+    try:
+        if mode not in ("record", "replay"):
+            raise AssertionError(f"Неизвестный режим кассеты `{mode}`")
+        interactions = dict()
+        if mode == "replay":
+            with gzip.open(cassette_path, "rt", encoding="utf-8") as fr:
+                interactions = json.load(fr)
+        with _CASSETTE_LOCK:
+            _CASSETTE.update({'mode': mode, 'path': cassette_path, 'interactions': interactions})
+    except Exception as e:
+        response['payload'] = str(e)
+    else:
+        response['success'] = True
+        response['payload'] = f"Кассета `{cassette_path}` включена в режиме {mode}"
+
+    return response
+
+
+def stop_cassette() -> dict:
+    """
+    Выключение кассеты; в режиме `record` записанные ответы сохраняются на диск. \n \n
+    :return: словарь вида STATE, payload - число записанных (воспроизводимых) запросов в случае успеха.
+    """
+    response = DEFAULT_RESPONSE.copy()
+    try:
+        with _CASSETTE_LOCK:
+            if _CASSETTE['mode'] == "record":
+                with gzip.open(_CASSETTE['path'], "wt", encoding="utf-8") as fw:
+                    json.dump(_CASSETTE['interactions'], fw, ensure_ascii=False)
+            counter = sum(len(records) for records in _CASSETTE['interactions'].values())
+            _CASSETTE.update({'mode': None, 'path': None, 'interactions': dict()})
+    except Exception as e:
+        response['payload'] = str(e)
+    else:
+        response['success'] = True
+        response['payload'] = counter
+
+    return response
+
+
+def cassette_mode():
+    """
+    Текущий режим кассеты: `record`, `replay` или None, если кассета выключена. Пока кассета включена,
+    дисковые кэши и реестры не должны смешивать воспроизводимые ответы с настоящими данными портала. \n \n
+    :return: режим кассеты или None.
+    """
+    return _CASSETTE['mode']
+
+
+def cassette_value(name: str, compute):
+    """
+    Значение локального состояния (например, реестра загрузок), от которого зависят запросы к порталу. В режиме
+    `record` значение вычисляется и записывается в кассету, в режиме `replay` берется из кассеты, чтобы
+    воспроизведение принимало те же решения, что и записанный прогон; без кассеты просто вычисляется. \n \n
+    :param name: имя значения, повторные значения с тем же именем выдаются в порядке записи;
+    :param compute: функция без аргументов, вычисляющая значение (должно сериализоваться в json);
+    :return: значение.
+    """
+    mode = _CASSETTE['mode']
+    if mode is None:
+        return compute()
+    key = f"value:{name}"
+    if mode == "replay":
+        with _CASSETTE_LOCK:
+            records = _CASSETTE['interactions'].get(key)
+            if not records:
+                raise AssertionError(f"В кассете нет значения `{name}`")
+            return records.pop(0) if len(records) > 1 else records[0]
+    value = compute()
+    with _CASSETTE_LOCK:
+        _CASSETTE['interactions'].setdefault(key, list()).append(value)
+    return value
+
+
+def portal_request(method: str, url: str, idempotent: bool = None, **kwargs) -> requests.Response:
+    """
+    Единая точка всех запросов к порталу. Без кассеты запрос идет через адаптивный ограничитель адреса
+    (`rate_limit` в настройках), с включенной кассетой -- записывается или воспроизводится (`start_cassette`).
+    Остальные аргументы совпадают с `requests.request`. \n \n
+    :param method: HTTP-метод;
+    :param url: полный адрес запроса;
+    :param idempotent: можно ли безопасно повторить запрос при 5xx и обрыве соединения; по умолчанию -- лишь
+    для GET, POST-запросы, которые только читают данные, должны передавать `idempotent=True` явно;
+    :return: requests.Response.
+    """
+    if idempotent is None:
+        idempotent = method.upper() in ("GET", "HEAD", "OPTIONS")
+    mode = _CASSETTE['mode']
+    if mode is None:
+        return _limited_request(method, url, idempotent, **kwargs)
+    key = _cassette_key(method, url, kwargs)
+    if mode == "replay":
+        with _CASSETTE_LOCK:
+            records = _CASSETTE['interactions'].get(key)
+            if not records:
+                raise requests.ConnectionError(f"В кассете нет ответа на {method} {url}")
+            # последний ответ не извлекаем, чтобы лишние повторы запроса получали его же
+            record = records.pop(0) if len(records) > 1 else records[0]
+        portal_response = requests.Response()
+        portal_response.status_code = record['status_code']
+        portal_response.headers.update(record['headers'])
+        portal_response._content = base64.b64decode(record['content'])
+        portal_response.encoding = record['encoding']
+        portal_response.url = url
+        return portal_response
+    portal_response = _limited_request(method, url, idempotent, **kwargs)
+    record = {
+        'status_code': portal_response.status_code,
+        'headers': {name: value for name, value in portal_response.headers.items()
+                    if name.lower() in ("content-type", "retry-after")},
+        'content': base64.b64encode(portal_response.content).decode(),
+        'encoding': portal_response.encoding
+    }
+    with _CASSETTE_LOCK:
+        _CASSETTE['interactions'].setdefault(key, list()).append(record)
+    return portal_response
+
+
+def _update_stage_digest(digest, value):
+    """
+    Добавление аргумента этапа в хэш: таблицы хэшируются по содержимому, пути к файлам -- по содержимому файла,
+    остальное -- по текстовому представлению.
+    """
+    if isinstance(value, pd.DataFrame):
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+        digest.update(repr(list(value.columns)).encode())
+        digest.update(repr(value.dtypes.astype(str).tolist()).encode())
+    elif isinstance(value, str) and os.path.isfile(value):
+        with open(value, "rb") as fr:
+            for chunk in iter(lambda: fr.read(1 << 20), b""):
+                digest.update(chunk)
+    else:
+        digest.update(repr(value).encode())
+
+
+def _evict_stage_cache(cache_dir: str, max_bytes: int):
+    """
+    Удаление давно не использованных результатов, пока кэш этапов не уложится в `max_bytes`.
+    """
+    entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith(".pkl")]
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in sorted(entries, key=lambda x: x.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def _restore_inplace(arguments: dict, response: dict) -> dict:
+    """
+    Этапы изменяют переданную таблицу inplace, поэтому при попадании в кэш переносим сохраненные столбцы
+    в таблицу вызывающего (первый аргумент-таблицу, переданный позиционно или по имени), а в payload подставляем
+    именно её.
+    """
+    payload = response['payload']
+    cached_df = payload[0] if isinstance(payload, tuple) else payload
+    df = next((value for value in arguments.values() if isinstance(value, pd.DataFrame)), None)
+    if df is not None and isinstance(cached_df, pd.DataFrame) and df.index.equals(cached_df.index):
+        for column in cached_df.columns:
+            df[column] = cached_df[column]
+        response['payload'] = (df,) + payload[1:] if isinstance(payload, tuple) else df
+    return response
+
+
+def _package_source_digest():
+    """
+    Хэш исходного кода всего пакета: результат этапа зависит не только от его собственного кода, но и от всех
+    вызываемых им функций, поэтому любое изменение модулей пакета делает прежние результаты недействительными.
+    """
+    digest = hashlib.sha256(pd.__version__.encode())
+    for name in sorted(os.listdir(WORKING_PATH)):
+        if name.endswith(".py"):
+            digest.update(name.encode())
+            with open(os.path.join(WORKING_PATH, name), "rb") as fr:
+                digest.update(fr.read())
+    return digest
+
+
+def memoize_stage(*settings):
+    """
+    Декоратор для локальных этапов пайплайна, возвращающих словарь вида STATE. Успешные результаты сохраняются на
+    диск (`stage_cache` в настройках) с ключом из хэша кода пакета и версии pandas, аргументов (содержимого таблиц
+    и входных файлов), переданных словарей настроек, схемы TABLE и настроек баркодов. При повторном вызове с теми же
+    входными данными результат берется из кэша без пересчета. \n \n
+    :param settings: словари настроек, от которых зависит результат этапа;
+    :return: декоратор.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_settings = default_settings['stage_cache']
+            if not cache_settings['enabled']:
+                return func(*args, **kwargs)
+            # аргументы связываем с параметрами, чтобы таблицы и пути, переданные по имени, хэшировались так же,
+            # как переданные позиционно
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            digest = _package_source_digest()
+            digest.update(func.__qualname__.encode())
+            for name, value in bound.arguments.items():
+                digest.update(name.encode())
+                _update_stage_digest(digest, value)
+            # схема TABLE и построение баркодов общие для всех этапов, поэтому входят в ключ всегда
+            digest.update(json.dumps([default_settings['table_schema'], default_settings['barcodes'], *settings],
+                                     sort_keys=True, ensure_ascii=False, default=str).encode())
+            cache_dir = os.path.expanduser(cache_settings['path'])
+            cache_path = os.path.join(cache_dir, f"{func.__name__}-{digest.hexdigest()}.pkl")
+            if os.path.exists(cache_path):
+                try:
+                    with open(cache_path, "rb") as fr:
+                        cached = pickle.load(fr)
+                except Exception:
+                    # испорченную запись просто пересчитываем
+                    os.remove(cache_path)
+                else:
+                    os.utime(cache_path)  # отмечаем использование для вытеснения давно не нужных результатов
+                    return _restore_inplace(bound.arguments, cached)
+            response = func(*args, **kwargs)
+            if response['success']:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(f"{cache_path}.tmp", "wb") as fw:
+                    pickle.dump(response, fw, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(f"{cache_path}.tmp", cache_path)
+                _evict_stage_cache(cache_dir, cache_settings['max_bytes'])
+            return response
+        return wrapper
+    return decorator
+
+
+def state_token(token, session: PortalSession = None) -> dict:
     """
     Функция для внесения токена авторизации и дальнейшего доступа на портал.
     Запрашивает информацию о пользователе в текущей сессии, если это не удается, значит токен введен некорректно. \n \n
     :param token: токен авторизации вида `58bac2b5851a4a7a832c30a02271045ef7b476e599134a19bc159e3ff7468e31`;
+    :param session: сессия портала, в которую вносится токен; по умолчанию -- `DEFAULT_SESSION`;
     :return: словарь вида STATE, payload - информация об авторизированном пользователе в случае успеха.
     """
     response = DEFAULT_RESPONSE.copy()
+    session = session or DEFAULT_SESSION
     try:
-        default_settings["access"]["token"] = token
-        default_settings["access"]["headers"]["Authorization"] = f"Bearer {token}"
-        test_request = requests.get(BASE_URL + default_settings['paths']['ping'],
-                                    headers=default_settings["access"]["headers"])
+        session.set_token(token)
+        if session is DEFAULT_SESSION:
+            default_settings["access"]["token"] = token
+        test_request = portal_request("GET", session.url(default_settings['paths']['ping']),
+                                      headers=session.headers)
     except Exception as e:
         response['payload'] = str(e)
     else:
@@ -3,7 +3,6 @@
 """
 import json
 
-import requests
 import pandas as pd
 
 from . import common
@@ -12,39 +11,73 @@ from . import common
 CONCLUSION_PIPE_SETTINGS = common.load_config(f"{common.WORKING_PATH}/conclusion_pipe_settings.yaml")
 
 
-def request_possible_conclusions():
+def _fetch_possible_conclusions(session: common.PortalSession) -> dict:
     """
-    Функция для запроса всех возможных заключений с портала, проверяет соответствие сохраненных локально вариантов
-    свежим вариантам.
-    Если варианты с портала хоть как-то не совпадают с вариантами, представленными в базе данных,
-    то 'success': False, так как необходимо устанавливать соответствия вручную. \n \n
-    :return: STATE-словарь, paylaod - текущий словарь и\или сообщение об ошибке, success как индикатор успеха
+    Запрос справочника возможных заключений с портала. \n \n
+    :param session: сессия портала;
+    :return: STATE-словарь, payload - словарь {заключение: id} в случае успеха.
     """
     response = common.DEFAULT_RESPONSE.copy()
     try:
-        vga_request = requests.get(common.BASE_URL + CONCLUSION_PIPE_SETTINGS["paths"]["conclusion_types"],
-                                   headers=common.default_settings["access"]["headers"])
+        vga_request = common.portal_request("GET",
+                                            session.url(CONCLUSION_PIPE_SETTINGS["paths"]["conclusion_types"]),
+                                            headers=session.headers)
     except Exception as e:
         response['payload'] = str(e)
     else:
         if vga_request.status_code == 200:
-            comparison_dict = dict()
-            for elem in vga_request.json():
-                comparison_dict[elem['text']] = elem['value']
-            if comparison_dict == CONCLUSION_PIPE_SETTINGS["conclusions"]["vga_conclusion_types"]:
-                response['success'] = True
-                response['payload'] = comparison_dict
-            else:
-                # здесь будет возвращаться False и новый словарь, в соответствии с которым нужно провести
-                # обновление вариантов заключений
-                response['payload'] = comparison_dict
+            response['success'] = True
+            response['payload'] = {elem['text']: elem['value'] for elem in vga_request.json()}
         else:
             response['payload'] = f"{vga_request.status_code}: {vga_request.text}`"
 
     return response
 
 
-def read_and_prepare_data(df: pd.DataFrame, pango_path: str, clades_path: str) -> dict:
+def request_possible_conclusions(force_refresh: bool = False, session: common.PortalSession = None):
+    """
+    Функция для запроса всех возможных заключений с портала, проверяет соответствие сохраненных локально вариантов
+    свежим вариантам. Справочник берется из дискового кэша `common.cached_portal_metadata`.
+    Если варианты с портала хоть как-то не совпадают с вариантами, представленными в базе данных,
+    то 'success': False, так как необходимо устанавливать соответствия вручную. \n \n
+    :param force_refresh: запросить справочник с портала вне зависимости от срока жизни кэша;
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
+    :return: STATE-словарь, paylaod - текущий словарь и\или сообщение об ошибке, success как индикатор успеха
+    """
+    response = common.DEFAULT_RESPONSE.copy()
+    session = session or common.DEFAULT_SESSION
+    cached = common.cached_portal_metadata("conclusion_types", lambda: _fetch_possible_conclusions(session),
+                                           force_refresh, session)
+    if cached['success']:
+        comparison_dict = cached['payload']
+        if comparison_dict == CONCLUSION_PIPE_SETTINGS["conclusions"]["vga_conclusion_types"]:
+            response['success'] = True
+            response['payload'] = comparison_dict
+        else:
+            # здесь будет возвращаться False и новый словарь, в соответствии с которым нужно провести
+            # обновление вариантов заключений
+            response['payload'] = comparison_dict
+    else:
+        response['payload'] = cached['payload']
+
+    return response
+
+
+def _conclusion_types(session: common.PortalSession) -> dict:
+    """
+    Справочник заключений {заключение: id} из кэша `common.cached_portal_metadata` для выставления заключений. \n \n
+    :param session: сессия портала;
+    :return: словарь заключений; при ошибке запроса поднимается исключение.
+    """
+    cached = common.cached_portal_metadata("conclusion_types", lambda: _fetch_possible_conclusions(session),
+                                           session=session)
+    if not cached['success']:
+        raise AssertionError(f"Не удалось получить справочник заключений: {cached['payload']}")
+    return cached['payload']
+
+
+@common.memoize_stage()
+def read_and_prepare_data(df: pd.DataFrame, pango_path: str, clades_path: str, with_reports: bool = False) -> dict:
     """
     Функция для прочтения входных данных и их подготовки. Под входными данными подразумевается таблица вида FULL_TABLE,
     файл с результатами работы Pangolin по этим образцам и файл с результатами работы NextClade по этим образцам.
@@ -53,27 +86,29 @@ def read_and_prepare_data(df: pd.DataFrame, pango_path: str, clades_path: str) -
     :param df: уже прочитанный DataFrame с данными после второго этапа;
     :param pango_path: путь к текстовой таблице с результатами работы Pangolin;
     :param clades_path: путь к текстовому json-файлу с результатами работы NextClade;
+    :param with_reports: вернуть в payload кортеж из DataFrame и отчетов о сведении баркодов
+    {`pango`/`nextclade`: отчет};
     :return: STATE-словарь, payload - DataFrame с обновленной информацией образцов в случае успеха
     """
     response = common.DEFAULT_RESPONSE.copy()
+    reports = dict()
     try:
         pango = pd.read_csv(pango_path)  # тут не добавляем разделитель, так как панголин всегда сохраняет адекватно
         with open(clades_path, "r") as file_read:
             clades = json.load(file_read)['results']  # тут сразу берем лишь тот кусок, с которым удобно работать
-        # итерируемся по результатам Pango и добавляем результаты в нашу таблицу сведением
-        for idx, row in pango.iterrows():
-            if row['taxon'] in df.index:  # чтобы не набрать лишнего в таблицу
-                df.loc[row['taxon'], 'pango'] = row['lineage']
-        cur_counter = df[(df['valid_seq']) & (df['pango'] == "")].shape[0]
+        # сводим результаты Pango с нашей таблицей по индексу, лишние записи при этом не попадают в таблицу
+        lineages = pango.set_index('taxon')['lineage']
+        lineages, reports['pango'] = common.join_by_barcode(df, lineages)
+        df['pango'] = pd.Categorical(lineages)
+        cur_counter = (df['valid_seq'].fillna(False) & df['pango'].isna()).sum()
         if cur_counter != 0:
             raise AssertionError(f"Как минимум один ({cur_counter}) из валидных образцов не получил результата Pango")
 
         # теперь проставим результаты Clades
-        for row in clades:
-            barcode = row['seqName'].replace(" ", "_")
-            if barcode in df.index:  # чтобы не набрать лишнего в таблицу
-                df.loc[barcode, 'nextclade'] = row['clade']
-        cur_counter = df[(df['valid_seq']) & (df['nextclade'] == "")].shape[0]
+        clades_series = pd.Series({row['seqName']: row['clade'] for row in clades}, dtype=object)
+        clades_series, reports['nextclade'] = common.join_by_barcode(df, clades_series)
+        df['nextclade'] = pd.Categorical(clades_series)
+        cur_counter = (df['valid_seq'].fillna(False) & df['nextclade'].isna()).sum()
         if cur_counter != 0:
             raise AssertionError(f"Как минимум один ({cur_counter}) из валидных образцов не получил результата Clades")
 
@@ -82,7 +117,7 @@ def read_and_prepare_data(df: pd.DataFrame, pango_path: str, clades_path: str) -
     else:
         # если все ок, то возвращаем обновленную табличку и хороший статус
         response['success'] = True
-        response['payload'] = df
+        response['payload'] = (df, reports) if with_reports else df
 
     return response
 
@@ -99,11 +134,9 @@ def state_conclusion_local(df: pd.DataFrame) -> dict:
     try:
         # считываем словарь соответствий локальных заключений и заключений VGARus
         cl_dict = CONCLUSION_PIPE_SETTINGS["conclusions"]["local"]
-        # локально проставляем заключения в соответствии с настройками
-        df['sequence_conclusion_local'] = df.apply(
-            lambda x: cl_dict[x.pango + "|" + x.nextclade] if cl_dict.get(x.pango + "|" + x.nextclade) else "NS",
-            axis=1
-        )
+        # локально проставляем заключения в соответствии с настройками, неизвестные сочетания -- "NS"
+        keys = df['pango'].astype("string") + "|" + df['nextclade'].astype("string")
+        df['sequence_conclusion_local'] = pd.Categorical(keys.map(cl_dict).fillna("NS"))
     except Exception as e:
         response['payload'] = str(e)
     else:
@@ -114,7 +147,7 @@ def state_conclusion_local(df: pd.DataFrame) -> dict:
     return response
 
 
-def request_samples_info(rdf: pd.DataFrame, increment: int = 40) -> dict:
+def request_samples_info(rdf: pd.DataFrame, increment: int = 40, session: common.PortalSession = None) -> dict:
     """
     Функция для запроса информации об образцах на основе их имен.
     Необходимо учитывать, что сервер не предоставляет информации больше,
@@ -125,30 +158,33 @@ def request_samples_info(rdf: pd.DataFrame, increment: int = 40) -> dict:
     Критические же ошибки (например, `500 Server Error`) должны останавливать работу всей функции.  \n \n
     :param increment:
     :param rdf: таблица с данными образцов;
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
     :return: STATE-словарь, payload - DataFrame с обновленными данными в случае успеха.
     """
     response = common.DEFAULT_RESPONSE.copy()
+    session = session or common.DEFAULT_SESSION
     try:
         df = rdf[rdf['sample_status_remote'] == 'Uploaded']
         names_array = df['sample_number'].values
         idx = 0
         while idx < names_array.size:
             concatenated_names = ", ".join(names_array[idx:idx+increment])  # получаем строку запроса
-            samples_info = requests.get(common.BASE_URL + CONCLUSION_PIPE_SETTINGS["paths"]["samples_info"],
-                                        headers=common.default_settings["access"]["headers"],
-                                        params={
-                                            "filter": json.dumps(
-                                                {
-                                                    "sample_number": concatenated_names
-                                                }
-                                            )
-                                        }
-                                        )
+            samples_info = common.portal_request("GET",
+                                                 session.url(CONCLUSION_PIPE_SETTINGS["paths"]["samples_info"]),
+                                                 headers=session.headers,
+                                                 params={
+                                                     "filter": json.dumps(
+                                                         {
+                                                             "sample_number": concatenated_names
+                                                         }
+                                                     )
+                                                 }
+                                                 )
             if samples_info.status_code == 200:
                 for row in samples_info.json():
                     ali_index = df[df['sample_number'] == row['sample']['sample_number']].index
                     if len(ali_index) == 1:
-                        rdf.loc[ali_index, 'sequence_vga_id'] = row['id']
+                        rdf.loc[ali_index, 'sequence_vga_id'] = str(row['id'])
                     else:
                         raise AssertionError(f"Найдено {len(ali_index)} соответствий для " +
                                              f"`{row['sample']['sample_number']}` (id {row['id']})")
@@ -156,7 +192,7 @@ def request_samples_info(rdf: pd.DataFrame, increment: int = 40) -> dict:
                 raise AssertionError(f"Request for {idx}:{idx + increment} failed with {samples_info.status_code}")
             idx += increment
         df = rdf[rdf['sample_status_remote'] == 'Uploaded']
-        cur_counter = df[df['sequence_vga_id'] == ""].shape[0]
+        cur_counter = df['sequence_vga_id'].isna().sum()
         if cur_counter != 0:
             raise AssertionError(f"Как минимум один ({cur_counter}) из образцов не получил id с портала")
 
@@ -170,14 +206,17 @@ def request_samples_info(rdf: pd.DataFrame, increment: int = 40) -> dict:
     return response
 
 
-def state_conclusion_remote(rdf: pd.DataFrame, increment: int = 40) -> dict:
+def state_conclusion_remote(rdf: pd.DataFrame, increment: int = 40, session: common.PortalSession = None) -> dict:
     """
     Функция для отправки результатов заключений на сервер. Аналогично запросу образцов, необходимо поэтапное (по 50
     образцов) выставление результатов. \n \n
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
     :return:
     """
     response = common.DEFAULT_RESPONSE.copy()
+    session = session or common.DEFAULT_SESSION
     try:
+        conclusion_types = _conclusion_types(session)
         # сперва выделяем группы образцов
         df = rdf[rdf['sample_status_remote'] == 'Uploaded']
         unique_results = df['sequence_conclusion_local'].unique()
@@ -185,19 +224,21 @@ def state_conclusion_remote(rdf: pd.DataFrame, increment: int = 40) -> dict:
             sub_df = df[df['sequence_conclusion_local'] == result_var]
             if result_var != "NS":
                 # делаем выборку DataFrame
-                ids_list = sub_df['sequence_vga_id'].to_list()
+                # в таблице id хранятся строками, а портал ожидает в теле запроса числа
+                ids_list = [int(vga_id) for vga_id in sub_df['sequence_vga_id']]
                 # итерационно перебираем для выставления результата
                 idx = 0
                 while idx < len(ids_list):
-                    change_req = requests.post(common.BASE_URL + CONCLUSION_PIPE_SETTINGS["paths"]["state_res"],
-                                               headers=common.default_settings["access"]["headers"],
-                                               data=json.dumps(
-                                                   {
-                                                       "uploads": ids_list[idx:idx+increment],
-                                                       "result_type": CONCLUSION_PIPE_SETTINGS["conclusions"]["vga_conclusion_types"][result_var],
-                                                       "comment": "Auto results"
-                                                   }
-                                               ))
+                    change_req = common.portal_request("POST",
+                                                       session.url(CONCLUSION_PIPE_SETTINGS["paths"]["state_res"]),
+                                                       headers=session.headers,
+                                                       data=json.dumps(
+                                                           {
+                                                               "uploads": ids_list[idx:idx+increment],
+                                                               "result_type": conclusion_types[result_var],
+                                                               "comment": "Auto results"
+                                                           }
+                                                       ))
                     if change_req.status_code == 200:
                         rdf.loc[sub_df.index, "sequence_conclusion_remote"] = "OK"
                         idx += increment
@@ -6,10 +6,11 @@
 NB: все функции, производящие манипуляции с DataFrame, делают их inplace, то есть возвращаются не копии.
 """
 import concurrent.futures
+import collections
+import hashlib
 import re
 
 import pandas as pd
-import requests
 import transliterate
 
 from . import common
@@ -18,6 +19,7 @@ from . import common
 REGISTRY_PIPE_SETTINGS = common.load_config(f"{common.WORKING_PATH}/registry_pipe_settings.yaml")
 
 
+@common.memoize_stage(REGISTRY_PIPE_SETTINGS)
 def read_input_tables(table_2_path: str, table_3_path: str, separator='\t') -> dict:
     """
     Функция для загрузки в память входных таблиц, с которыми ведется работа.
@@ -37,10 +39,8 @@ def read_input_tables(table_2_path: str, table_3_path: str, separator='\t') -> d
         if any(df2["Sample_name"].duplicated()):
             raise AssertionError(f"Дублирующиеся 'Sample_name': " +
                                  f"{', '.join(df2[df2['Sample_name'].duplicated()]['Sample_name'].tolist())}")
-        # создаем баркоды
-        barcodes = df2["Dispence_to"].apply(lambda x: f"{x}" if len(x) > 1 else f"0{x}")
-        # и словарь соответствий баркода штрихкоду Литеха
-        barcodes_dict = {x: y for x, y in zip(df2["Sample_name"], barcodes)}
+        # создаем баркоды и словарь соответствий баркода штрихкоду Литеха
+        barcodes_dict = dict(zip(df2["Sample_name"], common.make_barcodes(df2["Dispence_to"])))
         df3 = pd.read_csv(table_3_path,
                           sep=separator, dtype=str, encoding="utf-8",
                           names=REGISTRY_PIPE_SETTINGS["column_names"]["from_3"])
@@ -55,7 +55,10 @@ def read_input_tables(table_2_path: str, table_3_path: str, separator='\t') -> d
         if df_res.shape[0] == df2.shape[0]:
             # передаем созданные баркоды выбранным образцам
             try:
-                df_res["barcode"] = df_res["litech_barcode"].apply(lambda x: f"barcode{barcodes_dict[x]}_MN908947.3")
+                barcodes = df_res["litech_barcode"].map(barcodes_dict)
+                if barcodes.isna().any():
+                    raise KeyError(", ".join(df_res.loc[barcodes.isna(), "litech_barcode"]))
+                df_res["barcode"] = barcodes
             # если хоть какой-то образец не получит баркод, возникнет KeyError
             except KeyError as k_err:
                 response['payload'] = f"Какому-то образцу не удалось выставить баркод: {str(k_err)}"
@@ -71,35 +74,70 @@ def read_input_tables(table_2_path: str, table_3_path: str, separator='\t') -> d
     return response
 
 
-def single_registry_request(registry_id):
+def single_registry_request(registry_id, session: common.PortalSession = None):
     """
     Производит запрос информации по 'registry_id' реестру. Функция может использоваться как циклично, так и для
     конкурентных запросов. \n \n
-    :param registry_id: ID реестра для запроса.
+    :param registry_id: ID реестра для запроса;
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`.
     :return: request в сыром виде
     """
-    lil_request = requests.get(common.BASE_URL + REGISTRY_PIPE_SETTINGS["paths"]["registry_query"] + str(registry_id),
-                               headers=common.default_settings["access"]["headers"])
+    session = session or common.DEFAULT_SESSION
+    registry_url = session.url(REGISTRY_PIPE_SETTINGS["paths"]["registry_query"] + str(registry_id))
+    lil_request = common.portal_request("GET", registry_url, headers=session.headers)
     return lil_request
 
 
-def update_registry_info(path_registry_table: str) -> dict:
+def request_registries_list(session: common.PortalSession = None) -> dict:
+    """
+    Запрос списка всех реестров портала. \n \n
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
+    :return: словарь вида STATE, payload - словарь {registry_id: описание реестра} в случае успеха.
+    """
+    response = common.DEFAULT_RESPONSE.copy()
+    session = session or common.DEFAULT_SESSION
+    try:
+        registries_list = common.portal_request("GET",
+                                                session.url(REGISTRY_PIPE_SETTINGS["paths"]["get_registries_list"]),
+                                                headers=session.headers)
+    except Exception as e:
+        response['payload'] = str(e)
+    else:
+        if registries_list.ok:
+            response['success'] = True
+            # ключи -- строки, чтобы словарь без изменений сохранялся в json-кэш
+            response['payload'] = {str(elem['registry_id']): elem for elem in registries_list.json()}
+        else:
+            response['payload'] = f"Could not request registries list: {registries_list.status_code}: " \
+                                  f"{registries_list.text}"
+
+    return response
+
+
+def update_registry_info(path_registry_table: str, force_refresh: bool = False,
+                         session: common.PortalSession = None) -> dict:
     """
     Функция для запроса таблицы соответствия образцов реестрам. Использует конкурентные запросы. Для успешной работы
-    необходимо предварительное объявление токена через раздел common. Работает медленно, но все же быстрее, чем обычный
-    запрос через цикл. \n \n
-    :param path_registry_table: путь для сохранения таблицы реестров.
+    необходимо предварительное объявление токена через раздел common (или передача сессии с токеном).
+    Работает медленно, но все же быстрее, чем обычный запрос через цикл.
+    Список реестров берется из дискового кэша `common.cached_portal_metadata`. \n \n
+    :param path_registry_table: путь для сохранения таблицы реестров;
+    :param force_refresh: запросить список реестров с портала вне зависимости от срока жизни кэша;
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
     :return: словарь вида STATE, payload - DataFrame соответствия образцов реестрам
     """
     response = common.DEFAULT_RESPONSE.copy()
+    session = session or common.DEFAULT_SESSION
     try:
-        # В первую очередь запрашиваем весь список реестров
-        registries_list = requests.get(common.BASE_URL + REGISTRY_PIPE_SETTINGS["paths"]["get_registries_list"],
-                                       headers=common.default_settings["access"]["headers"])
-        if registries_list.ok:
-            # если удалось запросить список реестров, то начинаем запрашивать реестры по одному
+        # В первую очередь получаем весь список реестров
+        registries_list = common.cached_portal_metadata("registries_list",
+                                                        lambda: request_registries_list(session),
+                                                        force_refresh, session)
+        if registries_list['success']:
+            # если удалось получить список реестров, то начинаем запрашивать реестры по одному
             with concurrent.futures.ThreadPoolExecutor() as executor:
-                res = [executor.submit(single_registry_request, elem['registry_id']) for elem in registries_list.json()]
+                res = [executor.submit(single_registry_request, registry_id, session)
+                       for registry_id in registries_list['payload']]
                 concurrent.futures.wait(res)
             # просто копируем чужой код, чтобы не парсить самостоятельно :)
             depart_names, sample_numbers, values, registry_id = list(), list(), list(), list()
@@ -117,8 +155,7 @@ def update_registry_info(path_registry_table: str) -> dict:
             # сохраняем не через функцию из common, чтобы не нагромождать код зря
             csv.to_csv(path_registry_table, index=False, encoding="utf-8")
         else:
-            raise AssertionError(f"Could not request registries list: {registries_list.status_code}:" +
-                                 f" {registries_list.text}")
+            raise AssertionError(registries_list['payload'])
     except Exception as e:
         response['payload'] = str(e)
     else:
@@ -173,7 +210,8 @@ def append_desired_columns(df: pd.DataFrame) -> dict:
     КАЗАЛОСЬ БЫ, что таблица генерируется максимально криво, но текущая генерация:
      * позволяет определять порядок столбцов нужным образом, выделять нужные из них;
      * избавляет нас от операции дополнительной и\или последующей неудобной аллокации памяти;
-     * нравится мне. \n \n
+     * нравится мне.
+    Типы столбцов определяются `table_schema` из `common_settings.yaml`, незаполненные значения -- <NA>. \n \n
     :param df: таблица для расширения;
     :return: словарь вида STATE, payload - DataFrame с обновленными колонками в случае успеха
     """
@@ -187,11 +225,12 @@ def append_desired_columns(df: pd.DataFrame) -> dict:
             # если такое наименование есть в таблице баркодов и пересечений, то забираем значения оттуда
             if heading in df.columns:
                 future_df[heading] = df[heading].to_list()
-            # если такого наименования нет, то просто заполняем пустыми строками
+            # если такого наименования нет, то просто заполняем пропусками
             else:
-                future_df[heading] = ["" for _ in range(df.index.size)]
-        # создаем итоговую таблицу вида TABLE
-        df_res = pd.DataFrame(future_df).set_index('barcode')  # устанавливаем баркод в качестве индекса
+                future_df[heading] = [pd.NA for _ in range(df.index.size)]
+        # создаем итоговую таблицу вида TABLE и приводим столбцы к типам из схемы
+        df_res = common.apply_table_schema(pd.DataFrame(future_df))
+        df_res = df_res.set_index('barcode')  # устанавливаем баркод в качестве индекса
     except Exception as e:
         response['payload'] = str(e)
     # если не случилось исключений, то возвращаем её целиком
@@ -251,19 +290,169 @@ def old_fashion_search(row, target_reg_df):
     return row
 
 
+def normalize_sample_name(value: str) -> str:
+    """
+    Приведение имени образца к виду для приблизительного поиска: латиница, нижний регистр,
+    без пробелов и любых разделителей. \n \n
+    :param value: имя образца из таблицы Литеха или реестра;
+    :return: нормализованное имя.
+    """
+    if re.search('[а-яА-Я]', value):
+        value = transliterate.translit(value, reversed=True)
+    return re.sub(r"[\W_]+", "", value.lower())
+
+
+def levenshtein_distance(first: str, second: str) -> int:
+    """
+    Редакционное расстояние Левенштейна между двумя строками. \n \n
+    :param first: первая строка;
+    :param second: вторая строка;
+    :return: минимальное число вставок, удалений и замен символов.
+    """
+    if len(first) < len(second):
+        first, second = second, first
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+class FuzzyNameIndex:
+    """
+    Индекс нормализованных имен реестра для поиска всех имен в пределах `max_distance` правок. Кандидаты
+    отбираются по длине и числу общих биграмм (каждая правка портит не больше двух биграмм имени, дополненного
+    по краям), и лишь для них считается расстояние Левенштейна, а не для всего региона.
+    """
+    q = 2
+
+    def __init__(self):
+        self.names = list()  # нормализованные имена
+        self.entries = list()  # индексы строк реестра для каждого имени
+        self.name_ids = dict()
+        self.grams = dict()  # биграмма -> номера имен
+        self.lengths = dict()  # длина имени -> номера имен
+
+    @staticmethod
+    def name_grams(name: str) -> set:
+        padded = f"^{name}$"  # нормализованные имена не содержат этих символов
+        return {padded[i:i + FuzzyNameIndex.q] for i in range(len(padded) - FuzzyNameIndex.q + 1)}
+
+    def add(self, name: str, registry_index):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            self.entries.append(list())
+            for gram in self.name_grams(name):
+                self.grams.setdefault(gram, list()).append(name_id)
+            self.lengths.setdefault(len(name), list()).append(name_id)
+        self.entries[name_id].append(registry_index)
+
+    def search(self, name: str, max_distance: int) -> list:
+        grams = self.name_grams(name)
+        threshold = len(grams) - self.q * max_distance
+        if threshold > 0:
+            counts = collections.Counter()
+            for gram in grams:
+                counts.update(self.grams.get(gram, ()))
+            candidates = [name_id for name_id, counter in counts.items() if counter >= threshold]
+        else:
+            # для совсем коротких имен биграммный фильтр ничего не отсекает, остается лишь фильтр по длине
+            candidates = [name_id for length in range(len(name) - max_distance, len(name) + max_distance + 1)
+                          for name_id in self.lengths.get(length, ())]
+        found = list()
+        for name_id in candidates:
+            candidate = self.names[name_id]
+            if abs(len(candidate) - len(name)) > max_distance:
+                continue
+            distance = levenshtein_distance(name, candidate)
+            if distance <= max_distance:
+                found.extend((distance, registry_index) for registry_index in self.entries[name_id])
+        return sorted(found, key=lambda x: x[0])
+
+
+# индекс последнего снимка реестров: при повторной обработке с теми же реестрами он не строится заново
+_FUZZY_INDEX_CACHE = dict()
+
+
+def build_fuzzy_registry_index(df_registry: pd.DataFrame) -> dict:
+    """
+    Построение индекса для приблизительного поиска: отдельный `FuzzyNameIndex` для каждого региона (первые 4 символа
+    номера образца), чтобы поиск сразу ограничивался регионом образца. Индекс запоминается для снимка реестров
+    и повторно не строится, пока реестры не изменились. \n \n
+    :param df_registry: полная таблица реестров;
+    :return: словарь {сокращение региона: FuzzyNameIndex}.
+    """
+    snapshot = hashlib.sha256(pd.util.hash_pandas_object(df_registry[['sample_number', 'value']],
+                                                         index=True).values.tobytes()).hexdigest()
+    if snapshot in _FUZZY_INDEX_CACHE:
+        return _FUZZY_INDEX_CACHE[snapshot]
+    fuzzy_index = dict()
+    for registry_index, sample_number, value in zip(df_registry.index, df_registry['sample_number'],
+                                                    df_registry['value']):
+        if isinstance(value, str) and isinstance(sample_number, str):
+            fuzzy_index.setdefault(sample_number[:4], FuzzyNameIndex()).add(normalize_sample_name(value),
+                                                                           registry_index)
+    _FUZZY_INDEX_CACHE.clear()
+    _FUZZY_INDEX_CACHE[snapshot] = fuzzy_index
+    return fuzzy_index
+
+
+def fuzzy_registry_search(row, fuzzy_index: dict, df_registry: pd.DataFrame):
+    """
+    Приблизительный поиск реестра для образца, не найденного точным поиском подстроки. Ищутся имена реестра
+    в пределах `fuzzy_search.max_distance` правок в регионе образца. Ранжированные кандидаты записываются в
+    'registry_candidates'; если ближайший кандидат единственный, то его данные заносятся в строку со статусом
+    "FUZZY MATCH", иначе выставляется "FUZZY CANDIDATES". Такие образцы все равно требуют подтверждения. \n \n
+    :param row: строка таблицы TABLE;
+    :param fuzzy_index: индекс из `build_fuzzy_registry_index`;
+    :param df_registry: полная таблица реестров, по которой строился индекс;
+    :return: pd.Series -- результат поиска реестра.
+    """
+    region_index = fuzzy_index.get(row['region_short_name'])
+    if region_index is None:
+        return row
+    found = region_index.search(normalize_sample_name(row['litech_sample_name']),
+                        REGISTRY_PIPE_SETTINGS['fuzzy_search']['max_distance'])
+    if not found:
+        return row
+    found = found[:REGISTRY_PIPE_SETTINGS['fuzzy_search']['max_candidates']]
+    row['registry_candidates'] = "; ".join(f"{df_registry.loc[registry_index, 'sample_number']} "
+                                           f"{df_registry.loc[registry_index, 'value']} (d={distance})"
+                                           for distance, registry_index in found)
+    if len(found) == 1 or found[0][0] < found[1][0]:
+        row[['registry_id', 'depart_name', 'sample_number', 'sample_name_value']] = \
+            df_registry.loc[found[0][1], REGISTRY_PIPE_SETTINGS["column_names"]["registry"]].tolist()
+        row['registry_guess_status'] = "FUZZY MATCH"
+    else:
+        row['registry_guess_status'] = "FUZZY CANDIDATES"
+    return row
+
+
 # TODO: table_3 -- проверка уникальности 'litech_sample_name', иначе уведомление в статусе и остановка обработки образца
-def process_table_concatenation(df: pd.DataFrame, df_registry: pd.DataFrame) -> dict:
+@common.memoize_stage(REGISTRY_PIPE_SETTINGS)
+def process_table_concatenation(df: pd.DataFrame, df_registry: pd.DataFrame, fuzzy: bool = None) -> dict:
     """
     Функция для поиска номера реестра среди всех реестров на основе наивного поиска подстроки в строке,
     приводит текстовое обозначение степени уверенности в корректном результате. \n \n
     :param df: таблица с образцами, для которых ведется поиск;
     :param df_registry: полная таблица реестров;
+    :param fuzzy: искать ли приблизительные совпадения для "NO MATHCES", по умолчанию -- `fuzzy_search.enabled`;
     :return: словарь вида STATE, payload - DataFrame с обновленными данными в случае успеха.
     """
     response = common.DEFAULT_RESPONSE.copy()
+    if fuzzy is None:
+        fuzzy = REGISTRY_PIPE_SETTINGS['fuzzy_search']['enabled']
+    fuzzy_index = None
     try:
         transform_func = lambda x: transliterate.translit(x, reversed=True).lower() if bool(
             re.search('[а-яА-Я]', x)) else x.lower()
+        # имена организаций хранятся категориями, поэтому заранее объявляем все возможные из реестров
+        new_departs = set(df_registry['depart_name'].dropna()) - set(df['depart_name'].cat.categories)
+        df['depart_name'] = df['depart_name'].cat.add_categories(sorted(new_departs))
 
         for barcode in df.index:
             standard_go = False  # флаг для инициации старого поиска
@@ -299,11 +488,16 @@ def process_table_concatenation(df: pd.DataFrame, df_registry: pd.DataFrame) ->
                 # если код добрался сюда, то передавать измененную клон-строку нельзя, именно поэтому
                 # ранее использовалась deep копия строки!
                 ocd_res = old_fashion_search(row_clone.copy(deep=True), df_registry)
+                # если точных совпадений нет вовсе, то пробуем приблизительный поиск; индекс строим лишь однажды
+                if fuzzy and ocd_res['registry_guess_status'] == "NO MATHCES":
+                    if fuzzy_index is None:
+                        fuzzy_index = build_fuzzy_registry_index(df_registry)
+                    ocd_res = fuzzy_registry_search(ocd_res, fuzzy_index, df_registry)
                 # тут уже, как бы не отработало, сохраняем в результаты
                 df.loc[barcode, ['registry_id', 'depart_name', 'sample_number', 'sample_name_value',
-                                 'registry_guess_status']] = ocd_res[
+                                 'registry_guess_status', 'registry_candidates']] = ocd_res[
                                 ['registry_id', 'depart_name', 'sample_number', 'sample_name_value',
-                                 'registry_guess_status']]
+                                 'registry_guess_status', 'registry_candidates']]
     # здесь мало представляю, как может появиться Exception, но все же...
     except Exception as e:
         response['payload'] = str(e)
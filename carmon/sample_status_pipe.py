@@ -5,12 +5,12 @@ import os
 import base64
 import json
 import shutil
-import textwrap
+import hashlib
+import sqlite3
 import tempfile
 import datetime
 
 import pandas as pd
-import requests
 from Bio import SeqIO
 
 from . import common
@@ -19,57 +19,81 @@ from . import common
 SAMPLE_STATUS_DICT = common.load_config(f"{common.WORKING_PATH}/sample_status_pipe_settings.yaml")
 
 
-def request_sample_status_types() -> dict:
+def _fetch_sample_status_types(session: common.PortalSession) -> dict:
+    """
+    Запрос справочника статусов образцов с портала. \n \n
+    :param session: сессия портала;
+    :return: словарь вида STATE, payload - словарь {статус: id} в случае успеха.
+    """
     response = common.DEFAULT_RESPONSE.copy()
     try:
-        vga_request = requests.get(common.BASE_URL + SAMPLE_STATUS_DICT["paths"]["status_types"],
-                                   headers=common.default_settings["access"]["headers"])
+        vga_request = common.portal_request("GET", session.url(SAMPLE_STATUS_DICT["paths"]["status_types"]),
+                                            headers=session.headers)
     except Exception as e:
         response['payload'] = str(e)
     else:
         if vga_request.status_code == 200:
-            comparison_dict = dict()
-            for elem in vga_request.json():
-                comparison_dict[elem['text']] = elem['id']
-            if comparison_dict == SAMPLE_STATUS_DICT["status"]["vga_status_types"]:
-                response['success'] = True
-                response['payload'] = comparison_dict
-            else:
-                # здесь будет возвращаться False и новый словарь, в соответствии с которым нужно провести
-                # обновление вариантов статусов
-                response['payload'] = comparison_dict
+            response['success'] = True
+            response['payload'] = {elem['text']: elem['id'] for elem in vga_request.json()}
         else:
             response['payload'] = f"{vga_request.status_code}: {vga_request.text}`"
     return response
 
 
-def state_sample_status_local(df: pd.DataFrame, fasta_path: str) -> dict:
+def request_sample_status_types(force_refresh: bool = False, session: common.PortalSession = None) -> dict:
+    """
+    Проверка соответствия справочника статусов портала сохраненному в настройках. Справочник берется из
+    дискового кэша `common.cached_portal_metadata`, на портал запрос уходит лишь по истечении срока кэша. \n \n
+    :param force_refresh: запросить справочник с портала вне зависимости от срока жизни кэша;
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
+    :return: словарь вида STATE, payload - актуальный словарь статусов и\или сообщение об ошибке.
+    """
+    response = common.DEFAULT_RESPONSE.copy()
+    session = session or common.DEFAULT_SESSION
+    cached = common.cached_portal_metadata("status_types", lambda: _fetch_sample_status_types(session),
+                                           force_refresh, session)
+    if cached['success']:
+        comparison_dict = cached['payload']
+        if comparison_dict == SAMPLE_STATUS_DICT["status"]["vga_status_types"]:
+            response['success'] = True
+            response['payload'] = comparison_dict
+        else:
+            # здесь будет возвращаться False и новый словарь, в соответствии с которым нужно провести
+            # обновление вариантов статусов
+            response['payload'] = comparison_dict
+    else:
+        response['payload'] = cached['payload']
+    return response
+
+
+@common.memoize_stage(SAMPLE_STATUS_DICT)
+def state_sample_status_local(df: pd.DataFrame, fasta_path: str, with_reports: bool = False) -> dict:
     """
     Выставление локального заключения о качестве сиквенса для образца. \n \n
     :param df:
     :param fasta_path:
-    :return:
+    :param with_reports: добавить в payload третьим элементом отчеты о сведении баркодов {`fasta`: отчет};
+    :return: словарь вида STATE, payload - кортеж из TABLE и словаря {баркод: последовательность} для загрузки
+    в случае успеха.
     """
     response = common.DEFAULT_RESPONSE.copy()
     future_upload = dict()
+    reports = dict()
     try:
         with open(fasta_path, "r", encoding="utf-8") as fasta_file:  # открываем Fasta
-            for seq_record in SeqIO.parse(fasta_file, 'fasta'):  # начинаем итерацию по последовательностям
-                # получаем из FASTA имя последовательности и превращаем в баркод
-                current_barcode = f"{str(seq_record.id)}_MN908947.3"
-                # фактически просто игнорируем те результаты последовательности, что не входят в плашку
-                if current_barcode in df.index:
-                    # вычисляем ATGC состав
-                    atgc_count = sum(seq_record.seq.count(x) for x in ["A", "T", "G", "C"])
-                    # определяем, валидна ли последовательность
-                    valid = atgc_count > SAMPLE_STATUS_DICT["THRESHOLD"]
-                    # выставляем полученное значение в таблицу
-                    df.loc[current_barcode, 'valid_seq'] = valid
-                    # для валидных последовательностей сохраняем FASTA
-                    future_upload[current_barcode] = str(seq_record.seq)
+            sequences = pd.Series({seq_record.id: str(seq_record.seq)
+                                   for seq_record in SeqIO.parse(fasta_file, 'fasta')}, dtype=object)
+        # сводим последовательности с плашкой по баркоду, лишние последовательности в таблицу не попадают
+        sequences, reports['fasta'] = common.join_by_barcode(df, sequences)
+        sequences = sequences.dropna()
+        # вычисляем ATGC состав и определяем, валидна ли последовательность
+        atgc_count = sequences.map(lambda seq: sum(seq.count(x) for x in ["A", "T", "G", "C"]))
+        df.loc[sequences.index, 'valid_seq'] = atgc_count > SAMPLE_STATUS_DICT["THRESHOLD"]
+        # сохраняем FASTA для будущей загрузки
+        future_upload = sequences.to_dict()
         # проверяем, не появилось ли каких-то лишних записей
-        if df[df['valid_seq'] == ""].shape[0] != 0:
-            raise AssertionError(f"Не обнаружены в Fasta-файле: {', '.join(df[df['valid_seq'] == ''].index)}")
+        if df['valid_seq'].isna().any():
+            raise AssertionError(f"Не обнаружены в Fasta-файле: {', '.join(df[df['valid_seq'].isna()].index)}")
         # выставляем локальное заключение на основании угадывании реестра и качестве последовательности
         for barcode in df.index:
             if df.loc[barcode, 'valid_seq']:  # если последовательность валидная
@@ -90,24 +114,40 @@ def state_sample_status_local(df: pd.DataFrame, fasta_path: str) -> dict:
         response['payload'] = str(e)
     else:
         response['success'] = True
-        response['payload'] = df, future_upload
+        response['payload'] = (df, future_upload, reports) if with_reports else (df, future_upload)
 
     return response
 
 
-def request_samples_info(df: pd.DataFrame, increment: int = 40):
+def _status_types(session: common.PortalSession) -> dict:
+    """
+    Справочник статусов {статус: id} из кэша `common.cached_portal_metadata` для выставления статусов. \n \n
+    :param session: сессия портала;
+    :return: словарь статусов; при ошибке запроса поднимается исключение.
+    """
+    cached = common.cached_portal_metadata("status_types", lambda: _fetch_sample_status_types(session),
+                                           session=session)
+    if not cached['success']:
+        raise AssertionError(f"Не удалось получить справочник статусов: {cached['payload']}")
+    return cached['payload']
+
+
+def request_samples_info(df: pd.DataFrame, increment: int = 40, session: common.PortalSession = None):
     """
     Получение информации об образцах для выяснения их 'истинных' id, по которым в дальнейшем можно проставить статус
     образца. \n \n
     :param increment:
     :param df:
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
     :return:
     """
     response = common.DEFAULT_RESPONSE.copy()
+    session = session or common.DEFAULT_SESSION
     try:
+        status_types = _status_types(session)
         # тут хитрый момент, мы запрашиваем ID лишь для тех образцов,
         # которые были определены как подходящие для выставления хоть какого-то статуса
-        sub_df = df[df["sample_status_local"].isin(set(SAMPLE_STATUS_DICT["status"]["vga_status_types"]))]
+        sub_df = df[df["sample_status_local"].isin(set(status_types))]
         barcodes = sub_df.index.tolist()
         idx = 0
         # станем итерироваться по increment образцов
@@ -115,9 +155,11 @@ def request_samples_info(df: pd.DataFrame, increment: int = 40):
             # получаем срез списка имен образцов
             concatenated_sample_numbers = sub_df.loc[barcodes[idx:idx+increment], 'sample_number'].tolist()
             # запрашиваем информацию об образцах POST-запросом
-            samples_info = requests.post(common.BASE_URL + SAMPLE_STATUS_DICT["paths"]["samples_info"],
-                                         headers=common.default_settings["access"]["headers"],
-                                         data=json.dumps({"filter": concatenated_sample_numbers}))
+            # запрос лишь читает информацию об образцах, поэтому его можно безопасно повторять
+            samples_info = common.portal_request("POST", session.url(SAMPLE_STATUS_DICT["paths"]["samples_info"]),
+                                                 idempotent=True,
+                                                 headers=session.headers,
+                                                 data=json.dumps({"filter": concatenated_sample_numbers}))
             # если запрос прошел корректно, то обрабатываем результаты
             if samples_info.status_code == 200:
                 for row in samples_info.json():
@@ -126,7 +168,7 @@ def request_samples_info(df: pd.DataFrame, increment: int = 40):
                     ali_index = df[df['sample_number'] == row['sample']['sample_number']].index
                     # каждому образцу должен соответствовать лишь один
                     if len(ali_index) == 1:
-                        df.loc[ali_index, 'sample_vga_id'] = row['id']
+                        df.loc[ali_index, 'sample_vga_id'] = str(row['id'])
                     # если соответствует более чем один, то сообщаем об ошибке
                     else:
                         raise AssertionError(f"Найдено {len(ali_index)} соответствий для " +
@@ -137,8 +179,8 @@ def request_samples_info(df: pd.DataFrame, increment: int = 40):
             # после успешной итерации увеличиваем счетчик
             idx += increment
         # проверяем, все ли из выбранных образцов получили свои ID
-        sub_df = df[df["sample_status_local"].isin(set(SAMPLE_STATUS_DICT["status"]["vga_status_types"]))]
-        cur_counter = sub_df[sub_df['sample_vga_id'] == ""].shape[0]
+        sub_df = df[df["sample_status_local"].isin(set(status_types))]
+        cur_counter = sub_df['sample_vga_id'].isna().sum()
         if cur_counter != 0:
             raise AssertionError(f"Как минимум один ({cur_counter}) из образцов не получил id с портала")
     # возникшие ошибки обрабатываем
@@ -151,15 +193,117 @@ def request_samples_info(df: pd.DataFrame, increment: int = 40):
     return response
 
 
-def upload_sequences(df: pd.DataFrame, fasta_upload: dict, credentials: dict, archive_path: str) -> dict:
+def sequence_hash(sequence: str) -> str:
     """
-    Загрузка сиквенсов на сервер. Выбирает из TABLE те записи, для которых локальный статус выставлен
-    'Готов'. Не совершает никаких действий с теми образцами, что имеют иные статусы. \n \n
-    :param df:
-    :param fasta_upload:
-    :param credentials:
-    :param archive_path:
-    :return:
+    Хэш содержимого последовательности, не зависящий от регистра и переносов строк. \n \n
+    :param sequence: нуклеотидная последовательность;
+    :return: sha256 в шестнадцатеричном виде.
+    """
+    return hashlib.sha256("".join(sequence.split()).upper().encode()).hexdigest()
+
+
+def _connect_upload_registry(registry_path: str) -> sqlite3.Connection:
+    """
+    Открытие реестра загруженных последовательностей (SQLite) с созданием таблицы при необходимости.
+    Загрузки учитываются отдельно для каждого портала: отправка на тестовый портал не отменяет отправку на
+    основной. \n \n
+    :param registry_path: путь к файлу реестра;
+    :return: соединение с базой.
+    """
+    registry_path = os.path.expanduser(registry_path)
+    os.makedirs(os.path.dirname(registry_path) or ".", exist_ok=True)
+    connection = sqlite3.connect(registry_path)
+    connection.execute("CREATE TABLE IF NOT EXISTS uploads (portal TEXT NOT NULL, sample_number TEXT NOT NULL, "
+                       "sequence_hash TEXT NOT NULL, uploaded_at TEXT NOT NULL)")
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(uploads)")}
+    if "portal" not in columns:
+        # реестры, созданные до появления сессий, содержат лишь загрузки на основной портал
+        base_url = common.BASE_URL.replace("'", "''")
+        with connection:
+            connection.execute(f"ALTER TABLE uploads ADD COLUMN portal TEXT NOT NULL DEFAULT '{base_url}'")
+            connection.execute("DROP INDEX IF EXISTS idx_uploads_sample_number")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_uploads_portal_sample ON uploads (portal, sample_number)")
+    return connection
+
+
+def _last_uploaded_hash(connection: sqlite3.Connection, portal: str, sample_number: str):
+    row = connection.execute("SELECT sequence_hash FROM uploads WHERE portal = ? AND sample_number = ? "
+                             "ORDER BY rowid DESC LIMIT 1", (portal, sample_number)).fetchone()
+    return row[0] if row else None
+
+
+def wrap_sequence(sequence: str, width: int = SAMPLE_STATUS_DICT["fasta_line_width"]) -> str:
+    """
+    Разбиение последовательности на строки фиксированной длины для FASTA. В отличие от `textwrap.wrap`
+    не ищет пробелов и дефисов, а просто режет строку срезами. \n \n
+    :param sequence: последовательность в одну строку;
+    :param width: длина строки;
+    :return: последовательность, разбитая переносами строк.
+    """
+    return "\n".join([sequence[idx:idx + width] for idx in range(0, len(sequence), width)])
+
+
+def build_upload_payload(df: pd.DataFrame, barcode: str, fasta_record: str) -> bytes:
+    """
+    Тело запроса загрузки последовательности одного образца. \n \n
+    :param df: таблица вида TABLE;
+    :param barcode: баркод образца;
+    :param fasta_record: готовая FASTA-запись образца;
+    :return: сериализованное в json тело запроса.
+    """
+    single_sample = {
+        'sample_number': df.loc[barcode, 'sample_number'],
+        'sample_data': {
+            'sequence_name': df.loc[barcode, 'litech_barcode'],
+            'sample_type': '1',
+            'seq_area': '1',
+            'author': 'Говорун В.М.',
+            'genom_pick_method': 'nf_artic',
+            'method_ready_lib': 'MIDNIGHT',
+            'tech': '3',
+            'valid': True,
+            'seq_id': df.loc[barcode, 'sample_name_value']  # опциональный параметр
+        },
+        'sequence': fasta_record
+    }
+    return json.dumps([single_sample]).encode()
+
+
+def _upload_single_sequence(df: pd.DataFrame, barcode: str, sequence: str, special_headers: dict,
+                            tmp_fasta_path: str, session: common.PortalSession) -> bool:
+    """
+    Отправка на портал одной последовательности с записью результата в 'sample_status_remote' и сохранением
+    отправленного FASTA в папку будущего архива. FASTA-запись собирается один раз и используется
+    и для запроса, и для архива. \n \n
+    :return: True в случае успешной загрузки.
+    """
+    try:
+        fasta_record = f">DEZIN-{df.loc[barcode, 'litech_barcode']}\n{wrap_sequence(sequence)}"
+        single_upload = common.portal_request("POST", session.url(SAMPLE_STATUS_DICT["paths"]["upload"]),
+                                              headers=special_headers,
+                                              data=build_upload_payload(df, barcode, fasta_record))
+        if single_upload.status_code == 200:
+            df.loc[barcode, 'sample_status_remote'] = 'Uploaded'
+        else:
+            df.loc[barcode, 'sample_status_remote'] = f"Failed with " \
+                                                      f"{single_upload.status_code}:{single_upload.text}"
+            return False
+    # возникшие ошибки обрабатываем
+    except Exception as e:
+        df.loc[barcode, 'sample_status_remote'] = f"Failed with {str(e)}"
+        return False
+    else:
+        with open(os.path.join(tmp_fasta_path, f"dezin-{df.loc[barcode, 'litech_barcode']}.fasta"), "w") as ff:
+            ff.write(fasta_record)
+    return True
+
+
+def _send_sequences(df: pd.DataFrame, barcodes: list, fasta_upload: dict, credentials: dict, archive_path: str,
+                    registry_path: str, skip_unchanged: bool, session: common.PortalSession) -> dict:
+    """
+    Общая часть загрузки и повторной загрузки: отправка выбранных последовательностей, учет их хэшей в реестре
+    загрузок, отчет и архив отправленных FASTA. \n \n
+    :return: словарь вида STATE, payload - TABLE с обновленным 'sample_status_remote'.
     """
     response = common.DEFAULT_RESPONSE.copy()
 
@@ -172,67 +316,89 @@ def upload_sequences(df: pd.DataFrame, fasta_upload: dict, credentials: dict, ar
         "Content-Type": "application/json"
     }
     operation_status = True
-    for barcode in df.index:
-        if df.loc[barcode, 'sample_status_local'] == 'Готов':
-            try:
-                # тут, вообще говоря, надо подумать, как все красиво спихнуть в конфигурацию
-                beautiful_fasta = "\n".join(textwrap.wrap(fasta_upload.get(barcode), 60))
-                single_sample = {
-                    'sample_number': df.loc[barcode, 'sample_number'],
-                    'sample_data': {
-                        'sequence_name': df.loc[barcode, 'litech_barcode'],
-                        'sample_type': '1',
-                        'seq_area': '1',
-                        'author': 'Говорун В.М.',
-                        'genom_pick_method': 'nf_artic',
-                        'method_ready_lib': 'MIDNIGHT',
-                        'tech': '3',
-                        'valid': True,
-                        'seq_id': df.loc[barcode, 'sample_name_value']  # опциональный параметр
-                    },
-                    'sequence': f">DEZIN-{df.loc[barcode, 'litech_barcode']}\n{beautiful_fasta}"
-                }
-                single_upload = requests.post(common.BASE_URL + SAMPLE_STATUS_DICT["paths"]["upload"],
-                                              headers=special_headers,
-                                              data=json.dumps([single_sample]))
-                if single_upload.status_code == 200:
-                    df.loc[barcode, 'sample_status_remote'] = 'Uploaded'
-                else:
-                    df.loc[barcode, 'sample_status_remote'] = f"Failed with " \
-                                                              f"{single_upload.status_code}:{single_upload.text}"
-                    operation_status = False
-            # возникшие ошибки обрабатываем
-            except Exception as e:
-                df.loc[barcode, 'sample_status_remote'] = f"Failed with {str(e)}"
-                operation_status = False
+    skipped = 0
+    connection = None
+    try:
+        # при воспроизведении ничего не отправляется на самом деле, поэтому хэши пишутся во временный реестр
+        # в памяти, а решения о пропуске берутся из кассеты
+        connection = _connect_upload_registry(":memory:" if common.cassette_mode() == "replay" else registry_path)
+        for barcode in barcodes:
+            sequence = fasta_upload.get(barcode)
+            sample_number = df.loc[barcode, 'sample_number']
+            current_hash = sequence_hash(sequence) if sequence is not None else None
+            # последовательность уже лежит на портале в точно таком же виде -- повторно не отправляем
+            if skip_unchanged and current_hash and \
+                    common.cassette_value(f"upload_registry:{session.base_url}:{sample_number}",
+                                          lambda: _last_uploaded_hash(connection, session.base_url,
+                                                                      sample_number)) == current_hash:
+                df.loc[barcode, 'sample_status_remote'] = 'Uploaded'
+                skipped += 1
+                continue
+            if _upload_single_sequence(df, barcode, sequence, special_headers, tmp_fasta_path, session):
+                with connection:
+                    connection.execute("INSERT INTO uploads (portal, sample_number, sequence_hash, uploaded_at) "
+                                       "VALUES (?, ?, ?, ?)",
+                                       (session.base_url, sample_number, current_hash,
+                                        datetime.datetime.now().isoformat(timespec='seconds')))
             else:
-                with open(os.path.join(tmp_fasta_path, f"dezin-{df.loc[barcode, 'litech_barcode']}.fasta"), "w") as ff:
-                    ff.write(f">DEZIN-{df.loc[barcode, 'litech_barcode']}\n{beautiful_fasta}")
-
-    with open(os.path.join(tmp_fasta_path, f'{ts_mark.strftime("%y%m%d_%H%M")}_upload_report.txt'), "w") as ts_wr:
-        ts_wr.write(f"Upload start\t{ts_mark.strftime('%Y-%m-%d %H:%M')}\n")
-        ts_wr.write(f"Attempted to upload\t{df[df['sample_status_local'] == 'Готов'].shape[0]}\n")
-        ts_wr.write(f"Succeeded to upload\t{df[df['sample_status_remote'] == 'Uploaded'].shape[0]}\n")
-        ts_wr.write(f"Upload finish\t{datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
+                operation_status = False
 
-    common.make_archive(tmp_fasta_path, archive_path)
-    shutil.rmtree(tmp_fasta_path)
+        with open(os.path.join(tmp_fasta_path, f'{ts_mark.strftime("%y%m%d_%H%M")}_upload_report.txt'), "w") as ts_wr:
+            ts_wr.write(f"Upload start\t{ts_mark.strftime('%Y-%m-%d %H:%M')}\n")
+            ts_wr.write(f"Attempted to upload\t{len(barcodes)}\n")
+            ts_wr.write(f"Skipped as unchanged\t{skipped}\n")
+            uploaded = (df.loc[barcodes, 'sample_status_remote'] == 'Uploaded').sum() - skipped
+            ts_wr.write(f"Succeeded to upload\t{uploaded}\n")
+            ts_wr.write(f"Upload finish\t{datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}\n")
 
-    response['success'] = operation_status
-    response['payload'] = df
+        common.make_archive(tmp_fasta_path, archive_path)
+    except Exception as e:
+        response['payload'] = str(e)
+    else:
+        response['success'] = operation_status
+        response['payload'] = df
+    finally:
+        if connection is not None:
+            connection.close()
+        shutil.rmtree(tmp_fasta_path, ignore_errors=True)
 
     return response
 
 
-def state_sample_status_remote(df: pd.DataFrame, increment: int = 40, status: str = 'Брак сиквенса') -> dict:
+def upload_sequences(df: pd.DataFrame, fasta_upload: dict, credentials: dict, archive_path: str,
+                     registry_path: str = SAMPLE_STATUS_DICT["upload_registry"],
+                     session: common.PortalSession = None) -> dict:
+    """
+    Загрузка сиквенсов на сервер. Выбирает из TABLE те записи, для которых локальный статус выставлен
+    'Готов'. Не совершает никаких действий с теми образцами, что имеют иные статусы.
+    Последовательности, хэш которых совпадает с последним загруженным для этого номера образца, повторно
+    не отправляются, но получают 'Uploaded'. \n \n
+    :param df: таблица вида TABLE;
+    :param fasta_upload: словарь {баркод: последовательность} из `state_sample_status_local`;
+    :param credentials: словарь с 'login' и 'password' для загрузки;
+    :param archive_path: путь к архиву отправленных FASTA и отчета;
+    :param registry_path: путь к реестру загруженных последовательностей (SQLite);
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
+    :return: словарь вида STATE, payload - TABLE с обновленным 'sample_status_remote'.
+    """
+    barcodes = df[df['sample_status_local'] == 'Готов'].index.tolist()
+    return _send_sequences(df, barcodes, fasta_upload, credentials, archive_path, registry_path,
+                           skip_unchanged=True, session=session or common.DEFAULT_SESSION)
+
+
+def state_sample_status_remote(df: pd.DataFrame, increment: int = 40, status: str = 'Брак сиквенса',
+                               session: common.PortalSession = None) -> dict:
     """
     Отправка локальных статусов STATUS образцов на сервер.
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
     :return:
     """
     response = common.DEFAULT_RESPONSE.copy()
+    session = session or common.DEFAULT_SESSION
 
     try:
-        if status not in set(SAMPLE_STATUS_DICT["status"]["vga_status_types"]):
+        status_types = _status_types(session)
+        if status not in status_types:
             raise AssertionError(f"Неизвестный статус `{status}`")
         sub_df = df[df['sample_status_local'] == status]
         barcodes = sub_df.index.tolist()
@@ -242,15 +408,15 @@ def state_sample_status_remote(df: pd.DataFrame, increment: int = 40, status: st
             # получаем срез списка имен образцов
             concatenated_sample_ids = sub_df.loc[barcodes[idx:idx + increment], 'sample_vga_id'].tolist()
             # отправляем статус образцов POST-запросом
-            status_change = requests.post(common.BASE_URL + SAMPLE_STATUS_DICT["paths"]["status_change"],
-                                          headers=common.default_settings["access"]["headers"],
-                                          files={
-                                              "uploads": (None, ",".join(map(str, concatenated_sample_ids))),
-                                              "status": (None,
-                                                         str(SAMPLE_STATUS_DICT["status"]["vga_status_types"][status])),
-                                              "defect_id": (None, ''),
-                                              "auth_key": (None, common.default_settings["access"]["token"])
-                                          })
+            status_change = common.portal_request("POST",
+                                                  session.url(SAMPLE_STATUS_DICT["paths"]["status_change"]),
+                                                  headers=session.headers,
+                                                  files={
+                                                      "uploads": (None, ",".join(map(str, concatenated_sample_ids))),
+                                                      "status": (None, str(status_types[status])),
+                                                      "defect_id": (None, ''),
+                                                      "auth_key": (None, session.token)
+                                                  })
             # если запрос прошел корректно, то обрабатываем результаты
             if status_change.status_code == 200:
                 # в ответе должно быть True\False
@@ -267,7 +433,7 @@ def state_sample_status_remote(df: pd.DataFrame, increment: int = 40, status: st
             idx += increment
         # проверяем, всем ли из выбранных образцов удалось проставить статус
         sub_df = df[df['sample_status_local'] == status]
-        cur_counter = sub_df[sub_df['sample_status_remote'] == ""].shape[0]
+        cur_counter = sub_df['sample_status_remote'].isna().sum()
         if cur_counter != 0:
             raise AssertionError(f"Как минимум одному ({cur_counter}) образцу не удалось выставить статус")
     # возникшие ошибки обрабатываем
@@ -280,9 +446,32 @@ def state_sample_status_remote(df: pd.DataFrame, increment: int = 40, status: st
     return response
 
 
-# TODO: добавить функцию повторной загрузки fasta-файла для уже загруженного
-def repost_sample_sequence():
-    pass
+def repost_sample_sequence(df: pd.DataFrame, fasta_upload: dict, credentials: dict, archive_path: str,
+                           barcodes: list = None, force: bool = False,
+                           registry_path: str = SAMPLE_STATUS_DICT["upload_registry"],
+                           session: common.PortalSession = None) -> dict:
+    """
+    Повторная загрузка последовательностей для уже загруженных образцов, например после исправления сборки.
+    По умолчанию отправляются лишь те последовательности, содержимое которых изменилось с последней загрузки. \n \n
+    :param df: таблица вида TABLE;
+    :param fasta_upload: словарь {баркод: последовательность} с исправленными последовательностями;
+    :param credentials: словарь с 'login' и 'password' для загрузки;
+    :param archive_path: путь к архиву отправленных FASTA и отчета;
+    :param barcodes: баркоды для повторной загрузки, по умолчанию -- все баркоды из `fasta_upload`, имеющиеся в df;
+    :param force: отправить последовательности, даже если они не изменились;
+    :param registry_path: путь к реестру загруженных последовательностей (SQLite);
+    :param session: сессия портала, по умолчанию -- `common.DEFAULT_SESSION`;
+    :return: словарь вида STATE, payload - TABLE с обновленным 'sample_status_remote'.
+    """
+    if barcodes is None:
+        barcodes = [barcode for barcode in fasta_upload if barcode in df.index]
+    missing = [barcode for barcode in barcodes if barcode not in df.index or barcode not in fasta_upload]
+    if missing:
+        response = common.DEFAULT_RESPONSE.copy()
+        response['payload'] = f"Нет образца или последовательности для: {', '.join(missing)}"
+        return response
+    return _send_sequences(df, barcodes, fasta_upload, credentials, archive_path, registry_path,
+                           skip_unchanged=not force, session=session or common.DEFAULT_SESSION)
 
 
 # TODO: реализовать проверку успеха загрузки и выставления статусов